@@ -138,4 +138,16 @@ class DataTrainingArguments:
          metadata={ 
             "help": "is validation datasets" 
         }, 
-    )
\ No newline at end of file
+    )
+    predict_file: Optional[str] = field(
+         default=None, 
+         metadata={ 
+            "help": "text file with one document per line to summarize in batches with predict.py (default: None, read one document from stdin)" 
+        }, 
+    )
+    predict_batch_size: int = field(
+         default=8, 
+         metadata={ 
+            "help": "number of documents per generate call when predicting from predict_file (default: 8)" 
+        }, 
+    )
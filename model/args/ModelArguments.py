@@ -83,3 +83,7 @@ class ModelArguments :
         metadata={"help": "model type(pretrained model from huggingface, customized bigbart, customized longbart), [auto, bigbart, longbart, bigbart_tapt]"},
     )
     
+    inference_fp16: bool = field(
+        default=True,
+        metadata={"help": "Whether to cast the model weights (and so the decoder kv cache) to fp16 for generation on GPU"},
+    )
@@ -122,4 +122,17 @@ class CustomSeq2SeqTrainingArguments(Seq2SeqTrainingArguments):
             "help": "whether to be half warm-up"
         }
     )
+    # transformers 4.11 TrainingArguments has no bf16 / tf32 flags
+    use_bf16_autocast: bool = field(
+        default=False,
+        metadata={
+            "help": "whether to run forward / loss under bf16 autocast on GPU, parameters stay fp32 master weights (default: False)"
+        }
+    )
+    use_tf32: bool = field(
+        default=False,
+        metadata={
+            "help": "whether to allow tf32 matmuls and cudnn convolutions on Ampere+ GPUs (default: False)"
+        }
+    )
 
@@ -1,21 +1,24 @@
 import torch
 import torch.nn as nn
-import random
 import math
-import numpy as np
-from typing import Optional
+import inspect
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Optional, Tuple
 from packaging import version
 from transformers.utils import logging
 from torch.nn import CrossEntropyLoss
+from torch.utils.checkpoint import checkpoint_sequential
 
 
 from transformers import  BigBirdConfig, BigBirdPreTrainedModel
 
-from transformers.models.big_bird.modeling_big_bird import BigBirdEmbeddings, BigBirdEncoder, BigBirdLayer
+from transformers.models.big_bird.modeling_big_bird import (BigBirdEmbeddings, BigBirdEncoder, BigBirdLayer,
+                                                            BigBirdSelfAttention)
 from transformers.modeling_outputs import (BaseModelOutputWithPoolingAndCrossAttentions, 
                                            BaseModelOutputWithPastAndCrossAttentions, Seq2SeqLMOutput)
 
-from transformers.models.bart.modeling_bart import BartPretrainedModel, BartDecoderLayer, BartLearnedPositionalEmbedding, BartPretrainedModel
+from transformers.models.bart.modeling_bart import (BartAttention, BartPretrainedModel, BartDecoderLayer,
+                                                    BartLearnedPositionalEmbedding, BartPretrainedModel)
 from transformers.models.bart.configuration_bart import BartConfig
 
 from transformers.modeling_utils import PreTrainedModel
@@ -25,48 +28,223 @@ from transformers.models.encoder_decoder.configuration_encoder_decoder import En
 
 logger = logging.get_logger(__name__)
 
+# segment checkpointing of the decoder stack needs the non-reentrant implementation, the reentrant one does not
+# propagate gradients to tensors captured by the layers (the encoder hidden states)
+_NON_REENTRANT_CHECKPOINT_SEQUENTIAL = "use_reentrant" in inspect.signature(checkpoint_sequential).parameters
+
+try:
+    from liger_kernel.transformers import LigerFusedLinearCrossEntropyLoss
+except ImportError:
+    LigerFusedLinearCrossEntropyLoss = None
+
+
+# most negative representable value per floating dtype, used as the additive "masked out" value
+_FINFO_MIN = {dtype: torch.finfo(dtype).min for dtype in (torch.float32, torch.float16, torch.bfloat16, torch.float64)}
+
+
+_COMPILED_FUNCTIONS: Dict[Callable, Callable] = {}
+
+
+def compile_enabled(config) -> bool:
+    """
+    Whether `config.compile_forward` asks for `torch.compile` and the installed torch provides it.
+    """
+    if not getattr(config, "compile_forward", False):
+        return False
+    if not hasattr(torch, "compile"):
+        logger.warning("`compile_forward` is set but torch.compile is not available in this torch version, running eagerly.")
+        return False
+    return True
+
+def compiled(fn: Callable):
+    """
+    `torch.compile` of a plain function (or an unbound forward taking the module as first argument), compiled on
+    first use and shared by every caller. Nothing is stored on module instances, so they still pickle and deepcopy.
+    """
+    compiled_fn = _COMPILED_FUNCTIONS.get(fn)
+    if compiled_fn is None:
+        compiled_fn = _COMPILED_FUNCTIONS[fn] = torch.compile(fn, mode="reduce-overhead", dynamic=True)
+    return compiled_fn
+
 def shift_tokens_right(input_ids: torch.Tensor, pad_token_id: int, decoder_start_token_id: int):
     """
     Shift input ids one token to the right.
     """
-    shifted_input_ids = input_ids.new_zeros(input_ids.shape)
-    shifted_input_ids[:, 1:] = input_ids[:, :-1].clone()
-    shifted_input_ids[:, 0] = decoder_start_token_id
-
     if pad_token_id is None:
         raise ValueError("self.model.config.pad_token_id has to be defined.")
-    # replace possible -100 values in labels by `pad_token_id`
+
+    shifted_input_ids = nn.functional.pad(input_ids[:, :-1], (1, 0), value=decoder_start_token_id)
+    # replace possible -100 values in labels by `pad_token_id` (pad returns a fresh tensor, so in place is safe)
     shifted_input_ids.masked_fill_(shifted_input_ids == -100, pad_token_id)
 
     return shifted_input_ids
 
-def _make_causal_mask(input_ids_shape: torch.Size, dtype: torch.dtype, past_key_values_length: int = 0):
+def _make_causal_mask(
+    input_ids_shape: torch.Size, dtype: torch.dtype, device: torch.device, past_key_values_length: int = 0
+):
     """
-    Make causal mask used for bi-directional self-attention.
+    Make causal mask used for bi-directional self-attention. The mask is built directly on `device`.
     """
     bsz, tgt_len = input_ids_shape
-    mask = torch.full((tgt_len, tgt_len), float("-inf"))
-    mask_cond = torch.arange(mask.size(-1))
-    mask.masked_fill_(mask_cond < (mask_cond + 1).view(mask.size(-1), 1), 0)
-    mask = mask.to(dtype)
+    total_len = tgt_len + past_key_values_length
+    mask = torch.full((tgt_len, total_len), _FINFO_MIN[dtype], dtype=dtype, device=device)
+
+    # query i (at absolute position i + past_key_values_length) attends to every key up to its own position,
+    # which covers the whole past block without concatenating a separate zeros tensor
+    cols = torch.arange(total_len, device=device)
+    rows = torch.arange(tgt_len, device=device) + past_key_values_length
+    mask.masked_fill_(cols[None, :] <= rows[:, None], 0)
+    return mask[None, None, :, :].expand(bsz, 1, tgt_len, total_len)
+
+
+_MASK_CACHE_SIZE = 16
+
 
-    if past_key_values_length > 0:
-        mask = torch.cat([torch.zeros(tgt_len, past_key_values_length, dtype=dtype), mask], dim=-1)
-    return mask[None, None, :, :].expand(bsz, 1, tgt_len, tgt_len + past_key_values_length)
+def _lru_get(cache: "OrderedDict[Hashable, torch.Tensor]", key: Hashable, build: Callable[[], torch.Tensor]):
+    """
+    Return `cache[key]`, building it with `build()` on a miss. The least recently used entry is evicted once the
+    cache holds more than `_MASK_CACHE_SIZE` tensors.
+    """
+    value = cache.get(key)
+    if value is None:
+        value = build()
+        cache[key] = value
+        if len(cache) > _MASK_CACHE_SIZE:
+            cache.popitem(last=False)
+    else:
+        cache.move_to_end(key)
+    return value
 
 
 def _expand_mask(mask: torch.Tensor, dtype: torch.dtype, tgt_len: Optional[int] = None):
     """
     Expands attention_mask from `[bsz, seq_len]` to `[bsz, 1, tgt_seq_len, src_seq_len]`.
+    The additive mask is only materialized as `[bsz, 1, 1, src_seq_len]`; the tgt dim is a broadcast view.
     """
     bsz, src_len = mask.size()
     tgt_len = tgt_len if tgt_len is not None else src_len
 
-    expanded_mask = mask[:, None, None, :].expand(bsz, 1, tgt_len, src_len).to(dtype)
-
-    inverted_mask = 1.0 - expanded_mask
+    inverted_mask = 1.0 - mask[:, None, None, :].to(dtype)
+    inverted_mask = inverted_mask.masked_fill_(inverted_mask.bool(), _FINFO_MIN[dtype])
+
+    return inverted_mask.expand(bsz, 1, tgt_len, src_len)
+
+@torch.jit.script
+def fused_embed_add_dropout_ln(
+    word: torch.Tensor,
+    token_type_ids: torch.Tensor,
+    position_ids: torch.Tensor,
+    token_type_weight: torch.Tensor,
+    position_weight: torch.Tensor,
+    weight: torch.Tensor,
+    bias: torch.Tensor,
+    eps: float,
+    p: float,
+    training: bool,
+) -> torch.Tensor:
+    """
+    Look up the token type / position embeddings, sum them with the word embeddings, then dropout and LayerNorm,
+    all in one scripted graph so the lookups and the intermediate sums are fused instead of launched and
+    materialized one by one. Dropout before LayerNorm follows the BigBird reference implementation.
+    """
+    embeddings = word + nn.functional.embedding(token_type_ids, token_type_weight)
+    embeddings = embeddings + nn.functional.embedding(position_ids, position_weight)
+    embeddings = nn.functional.dropout(embeddings, p, training)
+    return nn.functional.layer_norm(embeddings, [embeddings.size(-1)], weight, bias, eps)
+
+@torch.jit.script
+def fused_embed_add_dropout_ln_with_doc(
+    word: torch.Tensor,
+    token_type_ids: torch.Tensor,
+    position_ids: torch.Tensor,
+    doc_type_ids: torch.Tensor,
+    token_type_weight: torch.Tensor,
+    position_weight: torch.Tensor,
+    doc_type_weight: torch.Tensor,
+    weight: torch.Tensor,
+    bias: torch.Tensor,
+    eps: float,
+    p: float,
+    training: bool,
+) -> torch.Tensor:
+    """
+    `fused_embed_add_dropout_ln` with doc type embeddings. Kept as a separate graph rather than an Optional branch
+    so each variant compiles to a single fused graph.
+    """
+    embeddings = word + nn.functional.embedding(token_type_ids, token_type_weight)
+    embeddings = embeddings + nn.functional.embedding(position_ids, position_weight)
+    embeddings = embeddings + nn.functional.embedding(doc_type_ids, doc_type_weight)
+    embeddings = nn.functional.dropout(embeddings, p, training)
+    return nn.functional.layer_norm(embeddings, [embeddings.size(-1)], weight, bias, eps)
+
+@torch.jit.script
+def fused_add_ln_dropout(
+    embeds: torch.Tensor,
+    positions: torch.Tensor,
+    weight: torch.Tensor,
+    bias: torch.Tensor,
+    eps: float,
+    p: float,
+    training: bool,
+) -> torch.Tensor:
+    """
+    Decoder counterpart of `fused_embed_add_dropout_ln`, with BART's LayerNorm-then-dropout order.
+    """
+    hidden_states = embeds + positions
+    hidden_states = nn.functional.layer_norm(hidden_states, [hidden_states.size(-1)], weight, bias, eps)
+    return nn.functional.dropout(hidden_states, p, training)
+
+@torch.jit.script
+def fused_add_ln_dropout_with_doc(
+    embeds: torch.Tensor,
+    positions: torch.Tensor,
+    doc_type_ids: torch.Tensor,
+    doc_type_weight: torch.Tensor,
+    doc_type_padding_idx: Optional[int],
+    weight: torch.Tensor,
+    bias: torch.Tensor,
+    eps: float,
+    p: float,
+    training: bool,
+) -> torch.Tensor:
+    """
+    `fused_add_ln_dropout` with doc type embeddings.
+    """
+    hidden_states = embeds + positions
+    hidden_states = hidden_states + nn.functional.embedding(doc_type_ids, doc_type_weight, doc_type_padding_idx)
+    hidden_states = nn.functional.layer_norm(hidden_states, [hidden_states.size(-1)], weight, bias, eps)
+    return nn.functional.dropout(hidden_states, p, training)
 
-    return inverted_mask.masked_fill(inverted_mask.bool(), torch.finfo(dtype).min)
+def _autocast_enabled() -> bool:
+    """
+    `torch.is_autocast_enabled` only reports CUDA autocast; CPU autocast has its own flag (torch >= 1.10),
+    which torch >= 2.4 queries through `torch.is_autocast_enabled("cpu")`.
+    """
+    if torch.is_autocast_enabled():
+        return True
+    if version.parse(torch.__version__) >= version.parse("2.4"):
+        return torch.is_autocast_enabled("cpu")
+    return hasattr(torch, "is_autocast_cpu_enabled") and torch.is_autocast_cpu_enabled()
+
+def _topk_from_hidden(
+    hidden_states: torch.Tensor, weight: torch.Tensor, bias: torch.Tensor, k: int = 5, chunk_size: int = 512
+):
+    """
+    Project decoder hidden states to the vocabulary and return the top-k probabilities and token indices.
+    The sequence is processed `chunk_size` positions at a time, so at most `[bsz, chunk_size, vocab]` logits
+    are alive at once.
+    """
+    topk_probs, topk_indices = [], []
+    for start in range(0, hidden_states.size(1), chunk_size):
+        lm_logits = nn.functional.linear(hidden_states[:, start : start + chunk_size], weight) + bias
+        # softmax is monotonic, so the top-k of the logits are the top-k tokens; only those k get normalized
+        # (against the full logsumexp) instead of materializing the softmax over the whole vocabulary
+        chunk_logits, chunk_indices = lm_logits.topk(k, dim=-1)
+        topk_probs.append((chunk_logits - torch.logsumexp(lm_logits, dim=-1, keepdim=True)).exp())
+        topk_indices.append(chunk_indices)
+    if len(topk_probs) == 1:
+        return topk_probs[0], topk_indices[0]
+    return torch.cat(topk_probs, dim=1), torch.cat(topk_indices, dim=1)
 
 class BigBirdConfigWithDoctype(BigBirdConfig):
     def __init__(self, doc_type_size: int=None, **kwargs):
@@ -98,15 +276,28 @@ class BigBirdEmbeddingsWithDoctype(BigBirdEmbeddings):
         if version.parse(torch.__version__) > version.parse("1.6.0"):
             self.register_buffer(
                 "token_type_ids",
-                torch.zeros(self.position_ids.size(), dtype=torch.long),
+                torch.zeros(self.position_ids.size(), dtype=torch.int32),
                 persistent=False,
             )
         # End copy
 
         self.rescale_embeddings = config.rescale_embeddings
         self.hidden_size = config.hidden_size
+        self.embed_scale = float(config.hidden_size ** 0.5) if config.rescale_embeddings else 1.0
+        # optional low precision (e.g. "bfloat16") for the memory bound lookup / sum / LayerNorm / dropout block;
+        # only activations are cast, the parameters stay fp32 master weights for the optimizer and layer_norm
+        # accumulates its statistics in fp32
+        embed_dtype = getattr(config, "embed_dtype", None)
+        self.embed_dtype = getattr(torch, embed_dtype) if isinstance(embed_dtype, str) else embed_dtype
+        # opt-in: inductor fuses the embedding adds, LayerNorm and dropout
+        self.compile_forward = compile_enabled(config)
+
+    def forward(self, *args, **kwargs):
+        if self.compile_forward:
+            return compiled(type(self)._forward)(self, *args, **kwargs)
+        return self._forward(*args, **kwargs)
     
-    def forward(
+    def _forward(
         self, input_ids=None, token_type_ids=None, position_ids=None, doc_type_ids=None, inputs_embeds=None, past_key_values_length=0
     ):
         if input_ids is not None:
@@ -128,30 +319,116 @@ class BigBirdEmbeddingsWithDoctype(BigBirdEmbeddings):
                 buffered_token_type_ids_expanded = buffered_token_type_ids.expand(input_shape[0], seq_length)
                 token_type_ids = buffered_token_type_ids_expanded
             else:
-                token_type_ids = torch.zeros(input_shape, dtype=torch.long, device=self.position_ids.device)
+                token_type_ids = torch.zeros(input_shape, dtype=torch.int32, device=self.position_ids.device)
 
         if inputs_embeds is None:
             inputs_embeds = self.word_embeddings(input_ids)
+            # freshly allocated by the lookup, so it can be scaled in place
+            if self.rescale_embeddings:
+                inputs_embeds.mul_(self.embed_scale)
+        elif self.rescale_embeddings:
+            inputs_embeds = inputs_embeds * self.embed_scale
 
-        if self.rescale_embeddings:
-            inputs_embeds = inputs_embeds * (self.hidden_size ** 0.5)
+        if self.embed_dtype is not None:
+            inputs_embeds = inputs_embeds.to(self.embed_dtype)
 
-        token_type_embeddings = self.token_type_embeddings(token_type_ids)
+        if doc_type_ids is not None:
+            embeddings = self._forward_with_doc(inputs_embeds, token_type_ids, position_ids, doc_type_ids)
+        else:
+            embeddings = self._forward_no_doc(inputs_embeds, token_type_ids, position_ids)
 
-        embeddings = inputs_embeds + token_type_embeddings
+        # outside autocast the encoder layers expect activations in the parameter dtype
+        if self.embed_dtype is not None and not _autocast_enabled():
+            embeddings = embeddings.to(self.word_embeddings.weight.dtype)
+        
+        return embeddings
 
-        position_embeddings = self.position_embeddings(position_ids)
-        embeddings += position_embeddings
+    def _cast(self, weight):
+        # under autocast the fused ops pick their own dtype, otherwise the fp32 weights are cast per call
+        if self.embed_dtype is None or _autocast_enabled():
+            return weight
+        return weight.to(self.embed_dtype)
+
+    def _forward_no_doc(self, inputs_embeds, token_type_ids, position_ids):
+        return fused_embed_add_dropout_ln(
+            inputs_embeds,
+            token_type_ids,
+            position_ids,
+            self._cast(self.token_type_embeddings.weight),
+            self._cast(self.position_embeddings.weight),
+            self._cast(self.LayerNorm.weight),
+            self._cast(self.LayerNorm.bias),
+            self.LayerNorm.eps,
+            self.dropout.p,
+            self.training,
+        )
 
-        if doc_type_ids is not None :
-            doc_type_embeddings = self.doc_type_embeddings(doc_type_ids)
-            embeddings += doc_type_embeddings
+    def _forward_with_doc(self, inputs_embeds, token_type_ids, position_ids, doc_type_ids):
+        return fused_embed_add_dropout_ln_with_doc(
+            inputs_embeds,
+            token_type_ids,
+            position_ids,
+            doc_type_ids,
+            self._cast(self.token_type_embeddings.weight),
+            self._cast(self.position_embeddings.weight),
+            self._cast(self.doc_type_embeddings.weight),
+            self._cast(self.LayerNorm.weight),
+            self._cast(self.LayerNorm.bias),
+            self.LayerNorm.eps,
+            self.dropout.p,
+            self.training,
+        )
 
-        embeddings = self.dropout(embeddings)
-        embeddings = self.LayerNorm(embeddings)
-        
-        return embeddings
 
+class BigBirdSdpaSelfAttention(BigBirdSelfAttention):
+    """
+    `original_full` self-attention routed through `torch.nn.functional.scaled_dot_product_attention` (flash /
+    memory-efficient kernels) when the installed torch provides it. Weights are the same as BigBirdSelfAttention.
+    Falls back to the eager implementation for decoder / cross-attention use, head masks and attention outputs.
+    """
+
+    def forward(
+        self,
+        hidden_states,
+        attention_mask=None,
+        head_mask=None,
+        encoder_hidden_states=None,
+        encoder_attention_mask=None,
+        past_key_value=None,
+        output_attentions=False,
+    ):
+        if (
+            not hasattr(nn.functional, "scaled_dot_product_attention")
+            or self.is_decoder
+            or encoder_hidden_states is not None
+            or head_mask is not None
+            or output_attentions
+        ):
+            return super().forward(
+                hidden_states,
+                attention_mask,
+                head_mask,
+                encoder_hidden_states,
+                encoder_attention_mask,
+                past_key_value,
+                output_attentions,
+            )
+
+        query_layer = self.transpose_for_scores(self.query(hidden_states))
+        key_layer = self.transpose_for_scores(self.key(hidden_states))
+        value_layer = self.transpose_for_scores(self.value(hidden_states))
+
+        # attention_mask is the additive extended mask [bsz, 1, 1, seq_len], broadcast over heads and queries
+        context_layer = nn.functional.scaled_dot_product_attention(
+            query_layer,
+            key_layer,
+            value_layer,
+            attn_mask=attention_mask,
+            dropout_p=self.dropout.p if self.training else 0.0,
+        )
+        context_layer = context_layer.permute(0, 2, 1, 3).reshape(*hidden_states.size()[:-1], self.all_head_size)
+
+        return (context_layer,)
 
 class BigBirdModelWithDoctype(BigBirdPreTrainedModel):
     def __init__(self, config, add_pooling_layer=True):
@@ -160,6 +437,12 @@ class BigBirdModelWithDoctype(BigBirdPreTrainedModel):
         self.config = config
 
         self.block_size = self.config.block_size
+        # sliced and expanded when no attention_mask is given, instead of allocating torch.ones every forward.
+        # Kept as bool (1 byte per token); masks are cast to the model dtype only when the additive masks are built
+        self.register_buffer(
+            "_default_attention_mask", torch.ones(config.max_position_embeddings, dtype=torch.bool), persistent=False
+        )
+        self._pad_cache: Dict = OrderedDict()
 
         self.embeddings = BigBirdEmbeddingsWithDoctype(config)
         self.encoder = BigBirdEncoder(config)
@@ -177,9 +460,21 @@ class BigBirdModelWithDoctype(BigBirdPreTrainedModel):
             )
             self.set_attention_type("original_full")
 
+        self.use_sdpa = getattr(config, "use_sdpa", True)
+        self._set_sdpa_attention()
+
         # Initialize weights and apply final processing
         self.post_init()
         
+    def _set_sdpa_attention(self):
+        # BigBirdAttention rebuilds its self-attention module whenever the attention type changes,
+        # so full attention layers are switched to the SDPA forward after every change; weights are kept as they are
+        if not self.use_sdpa or self.attention_type != "original_full":
+            return
+        for layer in self.encoder.layer:
+            if type(layer.attention.self) is BigBirdSelfAttention:
+                layer.attention.self.__class__ = BigBirdSdpaSelfAttention
+
     def post_init(self):
         """
         A method executed at the end of each Transformer model initialization, to execute code that needs the model's
@@ -210,6 +505,7 @@ class BigBirdModelWithDoctype(BigBirdPreTrainedModel):
             return
         self.attention_type = value
         self.encoder.set_attention_type(value)
+        self._set_sdpa_attention()
         
     def forward(
         self,
@@ -255,14 +551,14 @@ class BigBirdModelWithDoctype(BigBirdPreTrainedModel):
         past_key_values_length = past_key_values[0][0].shape[2] if past_key_values is not None else 0
 
         if attention_mask is None:
-            attention_mask = torch.ones(((batch_size, seq_length + past_key_values_length)), device=device)
+            attention_mask = self._default_attention_mask[: seq_length + past_key_values_length].expand(batch_size, -1)
         if token_type_ids is None:
             if hasattr(self.embeddings, "token_type_ids"):
                 buffered_token_type_ids = self.embeddings.token_type_ids[:, :seq_length]
                 buffered_token_type_ids_expanded = buffered_token_type_ids.expand(batch_size, seq_length)
                 token_type_ids = buffered_token_type_ids_expanded
             else:
-                token_type_ids = torch.zeros(input_shape, dtype=torch.long, device=device)
+                token_type_ids = torch.zeros(input_shape, dtype=torch.int32, device=device)
 
         # in order to use block_sparse attention, sequence_length has to be at least
         # bigger than all global attentions: 2 * block_size
@@ -310,6 +606,10 @@ class BigBirdModelWithDoctype(BigBirdPreTrainedModel):
             blocked_encoder_mask, band_mask, from_mask, to_mask = self.create_masks_for_block_sparse_attn(
                 attention_mask, self.block_size
             )
+            # the block sparse attention does float arithmetic on these masks
+            blocked_encoder_mask, band_mask, from_mask, to_mask = (
+                mask.to(self.dtype) for mask in (blocked_encoder_mask, band_mask, from_mask, to_mask)
+            )
             extended_attention_mask = None
 
         elif self.attention_type == "original_full":
@@ -400,10 +700,13 @@ class BigBirdModelWithDoctype(BigBirdPreTrainedModel):
         ), f"Sequence length must be multiple of block size, but sequence length is {seq_length}, while block size is {block_size}."
 
         def create_band_mask_from_inputs(from_blocked_mask, to_blocked_mask):
-            exp_blocked_to_pad = torch.cat(
-                [to_blocked_mask[:, 1:-3], to_blocked_mask[:, 2:-2], to_blocked_mask[:, 3:-1]], dim=2
-            )
-            band_mask = torch.einsum("blq,blk->blqk", from_blocked_mask[:, 2:-2], exp_blocked_to_pad)
+            bsz, n_blocks, blk_size = to_blocked_mask.size()
+            # sliding windows of 3 blocks as a view instead of concatenating three shifted copies
+            # [bsz, n_blocks - 4, 3, block_size]
+            exp_blocked_to_pad = to_blocked_mask.unfold(1, 3, 1)[:, 1:-1].transpose(-1, -2)
+            # [bsz, n_blocks - 4, block_size, 3, block_size] -> [bsz, n_blocks - 4, block_size, 3 * block_size]
+            band_mask = from_blocked_mask[:, 2:-2, :, None, None] * exp_blocked_to_pad.unsqueeze(2)
+            band_mask = band_mask.view(bsz, n_blocks - 4, blk_size, 3 * blk_size)
             band_mask.unsqueeze_(1)
             return band_mask
 
@@ -440,10 +743,10 @@ class BigBirdModelWithDoctype(BigBirdPreTrainedModel):
                 f"`config.block_size`: {block_size}"
             )
             if input_ids is not None:
-                input_ids = nn.functional.pad(input_ids, (0, padding_len), value=pad_token_id)
+                input_ids = self._pad_right(input_ids, padding_len, pad_token_id)
             if position_ids is not None:
                 # pad with position_id = pad_token_id as in modeling_bigbird.BigBirdEmbeddings
-                position_ids = nn.functional.pad(position_ids, (0, padding_len), value=pad_token_id)
+                position_ids = self._pad_right(position_ids, padding_len, pad_token_id)
             if inputs_embeds is not None:
                 input_ids_padding = inputs_embeds.new_full(
                     (batch_size, padding_len),
@@ -453,15 +756,99 @@ class BigBirdModelWithDoctype(BigBirdPreTrainedModel):
                 inputs_embeds_padding = self.embeddings(input_ids_padding)
                 inputs_embeds = torch.cat([inputs_embeds, inputs_embeds_padding], dim=-2)
 
-            attention_mask = nn.functional.pad(
-                attention_mask, (0, padding_len), value=False
-            )  # no attention on the padding tokens
-            token_type_ids = nn.functional.pad(token_type_ids, (0, padding_len), value=0)  # pad with token_type_id = 0
+            attention_mask = self._pad_right(attention_mask, padding_len, 0)  # no attention on the padding tokens
+            token_type_ids = self._pad_right(token_type_ids, padding_len, 0)  # pad with token_type_id = 0
             if doc_type_ids is not None:
-                doc_type_ids = nn.functional.pad(doc_type_ids, (0, padding_len), value=0) 
+                doc_type_ids = self._pad_right(doc_type_ids, padding_len, 0)
 
         return padding_len, input_ids, attention_mask, token_type_ids, doc_type_ids, position_ids, inputs_embeds
 
+    def _pad_right(self, tensor: torch.Tensor, padding_len: int, value: int):
+        """Right-pad the last dim of `tensor` with `value`, reusing a cached constant block for the padding."""
+        shape = tuple(tensor.shape[:-1]) + (padding_len,)
+        padding = _lru_get(
+            self._pad_cache,
+            (shape, value, tensor.dtype, tensor.device),
+            lambda: torch.full(shape, value, dtype=tensor.dtype, device=tensor.device),
+        )
+        return torch.cat([tensor, padding], dim=-1)
+
+class BartSdpaAttention(BartAttention):
+    """
+    BartAttention computed with `torch.nn.functional.scaled_dot_product_attention` (flash / memory-efficient
+    kernels) when the installed torch provides it. Weights and the past_key_value layout are the same as
+    BartAttention; head masks and attention outputs fall back to the eager implementation.
+    A past_key_value of `(None, None)` means "no cache yet", so a layer cache can carry precomputed cross-attention
+    key/values only (see `BartDecoderWithDoctype.precompute_cross_attn_key_values`).
+    """
+
+    use_sdpa = True
+
+    def forward(
+        self,
+        hidden_states: torch.Tensor,
+        key_value_states: Optional[torch.Tensor] = None,
+        past_key_value: Optional[Tuple[torch.Tensor]] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        layer_head_mask: Optional[torch.Tensor] = None,
+        output_attentions: bool = False,
+    ):
+        if past_key_value is not None and past_key_value[0] is None:
+            past_key_value = None
+
+        if (
+            not self.use_sdpa
+            or not hasattr(nn.functional, "scaled_dot_product_attention")
+            or layer_head_mask is not None
+            or output_attentions
+        ):
+            return super().forward(
+                hidden_states,
+                key_value_states=key_value_states,
+                past_key_value=past_key_value,
+                attention_mask=attention_mask,
+                layer_head_mask=layer_head_mask,
+                output_attentions=output_attentions,
+            )
+
+        # if key_value_states are provided this layer is used as a cross-attention layer for the decoder
+        is_cross_attention = key_value_states is not None
+        bsz, tgt_len, _ = hidden_states.size()
+
+        # SDPA applies the 1 / sqrt(head_dim) scaling itself
+        query_states = self._shape(self.q_proj(hidden_states), tgt_len, bsz)
+        if is_cross_attention and past_key_value is not None:
+            # reuse k, v, cross_attentions
+            key_states = past_key_value[0]
+            value_states = past_key_value[1]
+        elif is_cross_attention:
+            key_states = self._shape(self.k_proj(key_value_states), -1, bsz)
+            value_states = self._shape(self.v_proj(key_value_states), -1, bsz)
+        elif past_key_value is not None:
+            key_states = self._shape(self.k_proj(hidden_states), -1, bsz)
+            value_states = self._shape(self.v_proj(hidden_states), -1, bsz)
+            key_states = torch.cat([past_key_value[0], key_states], dim=2)
+            value_states = torch.cat([past_key_value[1], value_states], dim=2)
+        else:
+            key_states = self._shape(self.k_proj(hidden_states), -1, bsz)
+            value_states = self._shape(self.v_proj(hidden_states), -1, bsz)
+
+        if self.is_decoder:
+            past_key_value = (key_states, value_states)
+
+        # attention_mask is the additive [bsz, 1, tgt_len, src_len] mask (causal + padding for self-attention)
+        attn_output = nn.functional.scaled_dot_product_attention(
+            query_states,
+            key_states,
+            value_states,
+            attn_mask=attention_mask,
+            dropout_p=self.dropout if self.training else 0.0,
+        )
+        attn_output = attn_output.transpose(1, 2).reshape(bsz, tgt_len, self.embed_dim)
+        attn_output = self.out_proj(attn_output)
+
+        return attn_output, None, past_key_value
+
 class BartDecoderWithDoctype(BartPretrainedModel):
     """
     Transformer decoder consisting of *config.decoder_layers* layers. Each layer is a :class:`BartDecoderLayer`
@@ -495,10 +882,19 @@ class BartDecoderWithDoctype(BartPretrainedModel):
         )
         self.layers = nn.ModuleList([BartDecoderLayer(config) for _ in range(config.decoder_layers)])
         self.layernorm_embedding = nn.LayerNorm(config.d_model)
+        self._causal_mask_cache: Dict = OrderedDict()
+        # same weights, only the attention computation changes
+        use_sdpa = getattr(config, "use_sdpa", True)
+        for layer in self.layers:
+            for attention in (layer.self_attn, layer.encoder_attn):
+                attention.__class__ = BartSdpaAttention
+                attention.use_sdpa = use_sdpa
 
         self.gradient_checkpointing = False
         # Initialize weights and apply final processing
         self.post_init()
+
+        self.compile_forward = compile_enabled(config)
         
     def post_init(self):
         """
@@ -520,14 +916,50 @@ class BartDecoderWithDoctype(BartPretrainedModel):
     def set_input_embeddings(self, value):
         self.embed_tokens = value
 
+    def precompute_cross_attn_key_values(self, encoder_hidden_states: torch.Tensor):
+        """
+        Project `encoder_hidden_states` to every layer's cross-attention key/values once. The result is a
+        `past_key_values` tuple with empty self-attention slots, `(None, None, cross_key, cross_value)` per layer,
+        so several decoder passes over the same encoder outputs share the projections.
+        """
+        bsz = encoder_hidden_states.size(0)
+        return tuple(
+            (
+                None,
+                None,
+                layer.encoder_attn._shape(layer.encoder_attn.k_proj(encoder_hidden_states), -1, bsz),
+                layer.encoder_attn._shape(layer.encoder_attn.v_proj(encoder_hidden_states), -1, bsz),
+            )
+            for layer in self.layers
+        )
+
+    @staticmethod
+    def _layer_hidden_states_fn(layer, attention_mask, encoder_hidden_states, encoder_attention_mask):
+        """Bind the masks and encoder states of `layer` so it maps hidden states to hidden states (for checkpoint_sequential)."""
+        def forward(hidden_states):
+            return layer(
+                hidden_states,
+                attention_mask=attention_mask,
+                encoder_hidden_states=encoder_hidden_states,
+                encoder_attention_mask=encoder_attention_mask,
+                use_cache=False,
+            )[0]
+
+        return forward
+
     def _prepare_decoder_attention_mask(self, attention_mask, input_shape, inputs_embeds, past_key_values_length):
         # create causal mask
         # [bsz, seq_len] -> [bsz, 1, tgt_seq_len, src_seq_len]
         combined_attention_mask = None
         if input_shape[-1] > 1:
-            combined_attention_mask = _make_causal_mask(
-                input_shape, inputs_embeds.dtype, past_key_values_length=past_key_values_length
-            ).to(self.device)
+            bsz, tgt_len = input_shape
+            dtype, device = inputs_embeds.dtype, inputs_embeds.device
+            causal_mask = _lru_get(
+                self._causal_mask_cache,
+                (tgt_len, past_key_values_length, dtype, device),
+                lambda: _make_causal_mask((1, tgt_len), dtype, device, past_key_values_length=past_key_values_length),
+            )
+            combined_attention_mask = causal_mask.expand(bsz, -1, -1, -1)
 
         if attention_mask is not None:
             # [bsz, seq_len] -> [bsz, 1, tgt_seq_len, src_seq_len]
@@ -538,7 +970,14 @@ class BartDecoderWithDoctype(BartPretrainedModel):
 
         return combined_attention_mask
 
-    def forward(
+    def forward(self, *args, **kwargs):
+        # decided per call: the Trainer enables gradient checkpointing after construction,
+        # and compiled graphs do not compose with activation checkpointing
+        if self.compile_forward and not self.gradient_checkpointing:
+            return compiled(type(self)._forward)(self, *args, **kwargs)
+        return self._forward(*args, **kwargs)
+
+    def _forward(
         self,
         input_ids=None,
         attention_mask=None,
@@ -574,10 +1013,15 @@ class BartDecoderWithDoctype(BartPretrainedModel):
 
         # past_key_values_length
         # past_key_values shape: (batch_size, num_heads, sequence_length, embed_size_per_head)
-        past_key_values_length = past_key_values[0][0].shape[2] if past_key_values is not None else 0
+        # (precomputed cross-attention only caches have no self-attention entries yet)
+        past_key_values_length = (
+            past_key_values[0][0].shape[2] if past_key_values is not None and past_key_values[0][0] is not None else 0
+        )
 
         if inputs_embeds is None:
-            inputs_embeds = self.embed_tokens(input_ids) * self.embed_scale
+            inputs_embeds = self.embed_tokens(input_ids)
+            if self.embed_scale != 1.0:
+                inputs_embeds.mul_(self.embed_scale)
 
         attention_mask = self._prepare_decoder_attention_mask(
             attention_mask, input_shape, inputs_embeds, past_key_values_length
@@ -590,13 +1034,37 @@ class BartDecoderWithDoctype(BartPretrainedModel):
 
         # embed positions
         positions = self.embed_positions(input_shape, past_key_values_length)
-        if doc_type_ids is not None:
-            doc_type_embeddings = self.doc_type_tokens(doc_type_ids)
-        
-        hidden_states = inputs_embeds + positions + doc_type_embeddings if doc_type_ids is not None else inputs_embeds + positions
-        hidden_states = self.layernorm_embedding(hidden_states)
 
-        hidden_states = nn.functional.dropout(hidden_states, p=self.dropout, training=self.training)
+        if not self.gradient_checkpointing:
+            if doc_type_ids is not None:
+                hidden_states = fused_add_ln_dropout_with_doc(
+                    inputs_embeds,
+                    positions,
+                    doc_type_ids,
+                    self.doc_type_tokens.weight,
+                    self.doc_type_tokens.padding_idx,
+                    self.layernorm_embedding.weight,
+                    self.layernorm_embedding.bias,
+                    self.layernorm_embedding.eps,
+                    self.dropout,
+                    self.training,
+                )
+            else:
+                hidden_states = fused_add_ln_dropout(
+                    inputs_embeds,
+                    positions,
+                    self.layernorm_embedding.weight,
+                    self.layernorm_embedding.bias,
+                    self.layernorm_embedding.eps,
+                    self.dropout,
+                    self.training,
+                )
+        else:
+            hidden_states = inputs_embeds + positions
+            if doc_type_ids is not None:
+                hidden_states = hidden_states + self.doc_type_tokens(doc_type_ids)
+            hidden_states = self.layernorm_embedding(hidden_states)
+            hidden_states = nn.functional.dropout(hidden_states, p=self.dropout, training=self.training)
 
         # decoder layers
         all_hidden_states = () if output_hidden_states else None
@@ -612,11 +1080,51 @@ class BartDecoderWithDoctype(BartPretrainedModel):
                         "The `{mask_name}` should be specified for {len(self.layers)} layers, but it is for {head_mask.size()[0]}."
                     )
 
-        for idx, decoder_layer in enumerate(self.layers):
+        # sample LayerDrop for every layer at once; in eval (or without layerdrop) no layer is ever skipped
+        if self.training and self.layerdrop > 0:
+            dropout_probabilities = torch.rand(len(self.layers)).tolist()
+        else:
+            dropout_probabilities = [1.0] * len(self.layers)
+
+        decoder_layers = self.layers
+        if (
+            _NON_REENTRANT_CHECKPOINT_SEQUENTIAL
+            and self.gradient_checkpointing
+            and self.training
+            and not (output_attentions or output_hidden_states)
+            and head_mask is None
+            and cross_attn_head_mask is None
+            and past_key_values is None
+        ):
+            if use_cache:
+                logger.warning(
+                    "`use_cache=True` is incompatible with gradient checkpointing. Setting `use_cache=False`..."
+                )
+                use_cache = False
+                next_decoder_cache = None
+            # nothing but the last hidden state is needed, so checkpoint the (LayerDrop-filtered) stack
+            # in a few segments instead of layer by layer
+            kept_layers = [
+                layer for layer, dropout_probability in zip(self.layers, dropout_probabilities)
+                if not (dropout_probability < self.layerdrop)
+            ]
+            if kept_layers:
+                hidden_states = checkpoint_sequential(
+                    [
+                        self._layer_hidden_states_fn(layer, attention_mask, encoder_hidden_states, encoder_attention_mask)
+                        for layer in kept_layers
+                    ],
+                    min(4, len(kept_layers)),
+                    hidden_states,
+                    use_reentrant=False,
+                )
+            decoder_layers = ()
+
+        for idx, decoder_layer in enumerate(decoder_layers):
             # add LayerDrop (see https://arxiv.org/abs/1909.11556 for description)
             if output_hidden_states:
                 all_hidden_states += (hidden_states,)
-            dropout_probability = random.uniform(0, 1)
+            dropout_probability = dropout_probabilities[idx]
             if self.training and (dropout_probability < self.layerdrop):
                 continue
 
@@ -679,11 +1187,18 @@ class BartDecoderWithDoctype(BartPretrainedModel):
 
         next_cache = next_decoder_cache if use_cache else None
         if not return_dict:
-            return tuple(
-                v
-                for v in [hidden_states, next_cache, all_hidden_states, all_self_attns, all_cross_attentions]
-                if v is not None
-            )
+            # same layout as filtering the Nones out of
+            # (hidden_states, next_cache, all_hidden_states, all_self_attns, all_cross_attentions)
+            outputs = (hidden_states,)
+            if use_cache:
+                outputs += (next_cache,)
+            if output_hidden_states:
+                outputs += (all_hidden_states,)
+            if output_attentions:
+                outputs += (all_self_attns,)
+                if all_cross_attentions is not None:
+                    outputs += (all_cross_attentions,)
+            return outputs
         return BaseModelOutputWithPastAndCrossAttentions(
             last_hidden_state=hidden_states,
             past_key_values=next_cache,
@@ -722,11 +1237,13 @@ class EncoderDecoderModel(PreTrainedModel):
         self.encoder = encoder
         self.decoder = decoder
 
-        if self.encoder.config.to_dict() != self.config.encoder.to_dict():
+        # the configs are the very same object when the sub-models were built from this config;
+        # only serialize and compare them otherwise
+        if self.encoder.config is not self.config.encoder and self.encoder.config.to_dict() != self.config.encoder.to_dict():
             logger.warning(
                 f"Config of the encoder: {self.encoder.__class__} is overwritten by shared encoder config: {self.config.encoder}"
             )
-        if self.decoder.config.to_dict() != self.config.decoder.to_dict():
+        if self.decoder.config is not self.config.decoder and self.decoder.config.to_dict() != self.config.decoder.to_dict():
             logger.warning(
                 f"Config of the decoder: {self.decoder.__class__} is overwritten by shared decoder config: {self.config.decoder}"
             )
@@ -736,6 +1253,7 @@ class EncoderDecoderModel(PreTrainedModel):
         self.encoder.config = self.config.encoder
         self.decoder.config = self.config.decoder
         self.num_training_steps = self.decoder.config.num_training_steps if "num_training_steps" in dir(self.decoder.config) else None
+        self._embed_scale = math.sqrt(self.decoder.config.d_model)
         self.cur_training_steps = 0
 
 
@@ -778,6 +1296,16 @@ class EncoderDecoderModel(PreTrainedModel):
             self._tie_encoder_decoder_weights(
                 self.encoder, self.decoder._modules[decoder_base_model_prefix], self.decoder.base_model_prefix
             )
+        # the decoder reads the encoder word embeddings, so the lm_head can share that vocab matrix as well
+        # (one copy of the weights and of its optimizer state instead of two). Opt-in: existing checkpoints
+        # were trained with an untied lm_head and tying them would merge two distinct tensors on load
+        input_embeddings = self.get_input_embeddings()
+        if (
+            getattr(self.config, "tie_lm_head_to_embeddings", False)
+            and hasattr(self, "lm_head")
+            and self.lm_head.weight.shape == input_embeddings.weight.shape
+        ):
+            self._tie_or_clone_weights(self.lm_head, input_embeddings)
 
     def get_encoder(self):
         return self.encoder
@@ -828,7 +1356,9 @@ class EncoderDecoderModel(PreTrainedModel):
         else:
             self.cur_training_steps += 1
             teacher_training_ratio = (self.num_training_steps - self.cur_training_steps) / self.num_training_steps
-        use_outputs_ratio = np.random.rand()
+        # only sampled when scheduled sampling is active (teacher_training_ratio = 100 never takes that branch);
+        # drawn from the global CPU generator, which the Trainer seeds and saves with its checkpoints
+        use_outputs_ratio = 0.0 if self.num_training_steps is None else torch.rand(()).item()
 
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
 
@@ -866,35 +1396,48 @@ class EncoderDecoderModel(PreTrainedModel):
 
         # 1-stage decoder
         if teacher_training_ratio < use_outputs_ratio:
+            if past_key_values is None and not self.decoder.gradient_checkpointing:
+                # both decoder passes attend to the same encoder outputs, so project the cross-attention k/v once
+                past_key_values = self.decoder.precompute_cross_attn_key_values(encoder_hidden_states)
             self.decoder.eval()
-            decoder_outputs = self.decoder(
-                input_ids=decoder_input_ids,
-                attention_mask=decoder_attention_mask,
-                encoder_hidden_states=encoder_hidden_states,
-                encoder_attention_mask=attention_mask,
-                inputs_embeds=decoder_inputs_embeds,
-                output_attentions=output_attentions,
-                output_hidden_states=output_hidden_states,
-                use_cache=use_cache,
-                past_key_values=past_key_values,
-                return_dict=return_dict,
-                **kwargs_decoder,
-            )
-            decoder_hidden_states = decoder_outputs[0] # (batch_size, seq_size, hidden_size) 
-            lm_logits = self.lm_head(decoder_hidden_states) + self.final_logits_bias # (batch_size, seq_size, vocab_size)
-            lm_logits_softmax = torch.softmax(lm_logits,dim=-1)
-            topk_logits, topk_indices = torch.topk(lm_logits_softmax,k=5,dim=-1)
-            is_topk_indices_used = topk_logits.sum(dim=-1) > 0.5
+            # only the (non-differentiable) top-k indices and confidence mask of this pass are used,
+            # so it runs without building an autograd graph
+            with torch.no_grad():
+                decoder_outputs = self.decoder(
+                    input_ids=decoder_input_ids,
+                    attention_mask=decoder_attention_mask,
+                    encoder_hidden_states=encoder_hidden_states,
+                    encoder_attention_mask=attention_mask,
+                    inputs_embeds=decoder_inputs_embeds,
+                    output_attentions=output_attentions,
+                    output_hidden_states=output_hidden_states,
+                    use_cache=use_cache,
+                    past_key_values=past_key_values,
+                    return_dict=return_dict,
+                    **kwargs_decoder,
+                )
+                decoder_hidden_states = decoder_outputs[0] # (batch_size, seq_size, hidden_size) 
+                # with `compile_forward`, inductor fuses the bias add with the top-k / logsumexp reductions
+                topk_fn = compiled(_topk_from_hidden) if self.decoder.compile_forward else _topk_from_hidden
+                topk_logits, topk_indices = topk_fn(
+                    decoder_hidden_states, self.lm_head.weight, self.final_logits_bias, k=5
+                )
+                is_topk_indices_used = topk_logits.sum(dim=-1) > 0.5
+            del decoder_outputs
             
             # method2 : top-5
             topk_token_hidden_state = self.encoder.embeddings.word_embeddings(topk_indices)
-            topk_token_hidden_state_mean = torch.mean(topk_token_hidden_state, dim=-2)*math.sqrt(self.decoder.config.d_model)
+            # mean over the top-k and sqrt(d_model) scaling folded into one multiply of the sum
+            topk_token_hidden_state_mean = topk_token_hidden_state.sum(dim=-2).mul_(
+                self._embed_scale / topk_token_hidden_state.size(-2)
+            )
             decoder_inputs_embeds = self.encoder.embeddings.word_embeddings(decoder_input_ids)
-            decoder_inputs_embeds[is_topk_indices_used] = topk_token_hidden_state_mean[is_topk_indices_used]
+            # branchless select instead of a boolean-indexed scatter (no nonzero count / host sync)
+            decoder_inputs_embeds = torch.where(
+                is_topk_indices_used.unsqueeze(-1), topk_token_hidden_state_mean, decoder_inputs_embeds
+            )
             decoder_input_ids=None
             del decoder_hidden_states
-            del lm_logits
-            del lm_logits_softmax
             del topk_logits
             del topk_indices
             del is_topk_indices_used
@@ -917,13 +1460,30 @@ class EncoderDecoderModel(PreTrainedModel):
         )
 
         # Compute loss independent from decoder (as some shift the logits inside them)
-        lm_logits = self.lm_head(decoder_outputs[0]) + self.final_logits_bias
+        if (
+            labels is not None
+            and self.training
+            and LigerFusedLinearCrossEntropyLoss is not None
+            and getattr(self.config, "use_fused_linear_cross_entropy", False)
+        ):
+            # projection + cross entropy in chunks, the [bsz * seq_len, vocab] logits are never materialized
+            # (so they are not returned either; opt-in for training setups that only need the loss)
+            hidden_states = decoder_outputs[0]
+            lm_logits = None
+            loss = LigerFusedLinearCrossEntropyLoss()(
+                self.lm_head.weight,
+                hidden_states.view(-1, hidden_states.size(-1)),
+                labels.view(-1),
+                self.final_logits_bias.view(-1),
+            )
+        else:
+            lm_logits = self.lm_head(decoder_outputs[0]) + self.final_logits_bias
 
-        loss = None
-        if labels is not None:
-            loss_fct = CrossEntropyLoss()
-            # decoder의 d_model(vocab_size)가 encoder vocab_size로 대체(이유는 encoder word_embedding이 decoder word_embedding으로 대체)
-            loss = loss_fct(lm_logits.view(-1, self.config.encoder.vocab_size), labels.view(-1))
+            loss = None
+            if labels is not None:
+                loss_fct = CrossEntropyLoss()
+                # decoder의 d_model(vocab_size)가 encoder vocab_size로 대체(이유는 encoder word_embedding이 decoder word_embedding으로 대체)
+                loss = loss_fct(lm_logits.view(-1, self.config.encoder.vocab_size), labels.view(-1))
 
         if not return_dict:
             if loss is not None:
@@ -12,18 +12,48 @@ from utils.rouge import compute
 
 
 class PerformanceBenchmark:
-    def __init__(self, pipeline, dataset, tokenizer, optim_type='base line'):
+    def __init__(self, pipeline, dataset, tokenizer, optim_type='base line', batch_size=1):
         self.pipeline = pipeline
         self.dataset = dataset
         self.tokenizer = tokenizer
         self.optim_type = optim_type
+        self.batch_size = batch_size
+
+    def generate_batched(self, texts):
+        """
+        Summarize `texts` `batch_size` at a time. Texts are sorted by length first so each batch pads to
+        a similar length, then predictions are put back in the original order.
+        """
+        model = self.pipeline.model
+        device = self.pipeline.device
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        pred = [None] * len(texts)
+
+        for start in range(0, len(order), self.batch_size):
+            indices = order[start:start + self.batch_size]
+            inputs = self.tokenizer(
+                [texts[i] for i in indices], padding=True, truncation=True, return_tensors='pt'
+            )
+            if device.type == 'cuda':
+                inputs = {k: v.pin_memory().to(device, non_blocking=True) for k, v in inputs.items()}
+            else:
+                inputs = {k: v.to(device) for k, v in inputs.items()}
+            summary_ids = model.generate(input_ids=inputs['input_ids'], attention_mask=inputs['attention_mask'])
+            summaries = self.tokenizer.batch_decode(summary_ids, skip_special_tokens=True)
+            for i, summary in zip(indices, summaries):
+                pred[i] = summary
+
+        return pred
 
     def compute_rouge(self):
         rouge_scores = {}
-        pred = self.pipeline(self.dataset['text'])
         label = self.dataset['title']
 
-        pred = [key['summary_text'] for key in pred]
+        if self.batch_size > 1:
+            pred = self.generate_batched(self.dataset['text'])
+        else:
+            pred = self.pipeline(self.dataset['text'])
+            pred = [key['summary_text'] for key in pred]
         rouge_score = compute(pred, label, self.tokenizer)
 
         for key, value in rouge_score.items():
@@ -46,13 +76,13 @@ class PerformanceBenchmark:
         print(f"Model size (MB) = {size_mb}")
         return {'size_mb': size_mb}
 
-    def compute_time(self, query :str = '최근 대부분의 범죄에 디지털 매체가 사용되면서 디지털 데이터는 필수 조사 대상이 되었다. 하지만 디지털 데이터는 비교적 쉽게 삭제 및변조가 가능하다. 따라서 디지털 증거 획득을 위해 삭제된 데이터의 복구가 필요하며, 파일 카빙은 컴퓨터 포렌식 조사에서 증거를 획득할 수있는 중요한 요소이다. 하지만 현재 사용되는 파일 카빙 도구들은 포렌식 조사를 위한 데이터의 선별을 고려하지 않고 있다. 또 기존의 파일카빙 기법들은 파일의 일부 영역이 덮어써지거나 조각날 경우 복구가 불가능한 단점이 있다. 따라서 본 논문에서는 포렌식 조사시 유용한 정보를 획득할 수 있는 파일을 제안하고, 기존의 파일 카빙 기법보다 효과적으로 데이터를 복구할 수 있는 레코드 파일 카빙 기법을 제시한다.'):
+    def compute_time(self, query :str = '최근 대부분의 범죄에 디지털 매체가 사용되면서 디지털 데이터는 필수 조사 대상이 되었다. 하지만 디지털 데이터는 비교적 쉽게 삭제 및변조가 가능하다. 따라서 디지털 증거 획득을 위해 삭제된 데이터의 복구가 필요하며, 파일 카빙은 컴퓨터 포렌식 조사에서 증거를 획득할 수있는 중요한 요소이다. 하지만 현재 사용되는 파일 카빙 도구들은 포렌식 조사를 위한 데이터의 선별을 고려하지 않고 있다. 또 기존의 파일카빙 기법들은 파일의 일부 영역이 덮어써지거나 조각날 경우 복구가 불가능한 단점이 있다. 따라서 본 논문에서는 포렌식 조사시 유용한 정보를 획득할 수 있는 파일을 제안하고, 기존의 파일 카빙 기법보다 효과적으로 데이터를 복구할 수 있는 레코드 파일 카빙 기법을 제시한다.', warmup_iters: int = 10, measured_iters: int = 100):
         times = []
 
-        for i in range(10):
+        for i in range(warmup_iters):
             self.pipeline(query)
 
-        for i in range(100):
+        for i in range(measured_iters):
             start_time = perf_counter()
             self.pipeline(query)
             time = perf_counter() - start_time
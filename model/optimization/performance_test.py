@@ -14,6 +14,11 @@ from .performanceBenchmark import PerformanceBenchmark
 
 load_dotenv(verbose=True)
 
+def load_test_dataset(test_dataset, test_dataset_size, seed=42):
+    api_token = os.getenv('USE_AUTH_TOKEN')
+    dataset = datasets.load_dataset(test_dataset, use_auth_token=api_token)
+    return dataset['validation'].shuffle(seed=seed).filter(lambda x: len(x['text'])< 500).select(range(test_dataset_size))
+
 def performance_test(
     *,
     check_point = 'gogamza/kobart-summarization',
@@ -24,22 +29,26 @@ def performance_test(
     tokenizer=None,
     model=None,
     seed=42,
+    batch_size=1,
+    warmup_iters=10,
+    measured_iters=100,
     args=None
 ):
     device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
-    api_token = os.getenv('USE_AUTH_TOKEN')
     if args:
         check_point = args.check_point
         test_dataset = args.test_dataset
         test_dataset_size = args.test_dataset_size
         cpu_flag = args.cpu_flag
         test_categories = args.test_categories
+        batch_size = args.batch_size
 
     if cpu_flag:
         device='cpu'
 
-    dataset = datasets.load_dataset(test_dataset, use_auth_token=api_token)
-    test_dataset = dataset['validation'].shuffle(seed=seed).filter(lambda x: len(x['text'])< 500).select(range(test_dataset_size))
+    # an already loaded dataset slice can be shared across several runs
+    if isinstance(test_dataset, str):
+        test_dataset = load_test_dataset(test_dataset, test_dataset_size, seed=seed)
     
     if not tokenizer:
         tokenizer = AutoTokenizer.from_pretrained(check_point)
@@ -57,17 +66,20 @@ def performance_test(
         device = 0 if torch.cuda.is_available() and not cpu_flag else -1
     )
 
-    performance_benchmark = PerformanceBenchmark(summerizer, test_dataset, tokenizer, 'baseline')
+    performance_benchmark = PerformanceBenchmark(summerizer, test_dataset, tokenizer, 'baseline', batch_size=batch_size)
 
+    metrics = {}
     test_categories = test_categories.split(',')
     if 'rouge' in test_categories:
-        performance_benchmark.compute_rouge()
+        metrics.update(performance_benchmark.compute_rouge())
     
     if 'size' in test_categories:
-        performance_benchmark.compute_size()
+        metrics.update(performance_benchmark.compute_size())
     
     if 'time' in test_categories:
-        performance_benchmark.compute_time()
+        metrics.update(performance_benchmark.compute_time(warmup_iters=warmup_iters, measured_iters=measured_iters))
+
+    return metrics
 
 def main(args):
     performance_test(args=args)
@@ -80,6 +92,7 @@ if __name__ == '__main__':
     parser.add_argument('--test_dataset_size', type=int, default=1000, help='test dataset size (defualt: 1000)')
     parser.add_argument('--cpu_flag', action='store_true', help='use cpu (default: gpu)')
     parser.add_argument('--test_categories', type=str, default='rouge,time,size', help='test categories seperated by , ex: time,size,rouge (defualt: rouge,time,size)')
+    parser.add_argument('--batch_size', type=int, default=1, help='rouge generation batch size, texts are length-bucketed (default: 1)')
 
     args = parser.parse_args()
 
@@ -1,13 +1,127 @@
 import torch
 import torch.nn as nn
-from torch.quantization import quantize_dynamic
+from torch.quantization import quantize_dynamic, default_dynamic_qconfig, float16_dynamic_qconfig
 from transformers import AutoTokenizer
 from transformers import AutoModelForSeq2SeqLM
+from transformers.modeling_outputs import BaseModelOutput, Seq2SeqLMOutput
 
+import os
 import argparse
+import copy
+import functools
+import gc
+import platform
 
 import performance_test
 
+
+# not cached: every entry point loads the fp32 model once, and a cached copy would stay alive next to the
+# quantized / half precision model during the benchmark
+def _load_fp32(check_point):
+    return AutoModelForSeq2SeqLM.from_pretrained(check_point)
+
+
+@functools.lru_cache(maxsize=2)
+def _load_tokenizer(check_point):
+    return AutoTokenizer.from_pretrained(check_point)
+
+
+@functools.lru_cache(maxsize=None)
+def _has_cpu_flag(flag):
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('flags'):
+                    return flag in line.split(':', 1)[1].split()
+    except OSError:
+        pass
+    return False
+
+
+def _half_dtype(precision):
+    """
+    Pick the half precision dtype. CPU has no fp16 GEMM kernels (it silently upcasts and runs slower than fp32),
+    so fp16 is only used on CUDA and CPU falls back to bf16 when AVX512_BF16 is available, otherwise fp32.
+    """
+    if precision == 'fp16':
+        if not torch.cuda.is_available():
+            raise ValueError("fp16 precision is not supported on CPU, use bf16 instead")
+        return torch.float16
+    if precision == 'bf16':
+        return torch.bfloat16
+    if precision == 'auto':
+        if torch.cuda.is_available():
+            return torch.float16
+        return torch.bfloat16 if _has_cpu_flag('avx512_bf16') else torch.float32
+    raise ValueError(f"precision can only be set to 'auto', 'fp16' or 'bf16', but is {precision}")
+
+
+def _set_quantized_engine(quant_engine='auto'):
+    """
+    Pick the int8 kernel backend: qnnpack on ARM, onednn on x86 with AVX512-VNNI (when this torch build ships it),
+    fbgemm otherwise.
+    """
+    if quant_engine == 'auto':
+        machine = platform.machine().lower()
+        if 'aarch64' in machine or 'arm' in machine:
+            quant_engine = 'qnnpack'
+        elif _has_cpu_flag('avx512_vnni') and 'onednn' in torch.backends.quantized.supported_engines:
+            quant_engine = 'onednn'
+        else:
+            quant_engine = 'fbgemm'
+    if quant_engine not in torch.backends.quantized.supported_engines:
+        raise ValueError(
+            f"quant_engine {quant_engine} is not supported, choose from {torch.backends.quantized.supported_engines}"
+        )
+    torch.backends.quantized.engine = quant_engine
+
+
+def _set_quantized_threads():
+    """
+    Use every core this process is pinned to for the quantized kernels.
+    OMP_NUM_THREADS / MKL_NUM_THREADS, when exported before launch, should match this count.
+    """
+    n = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    torch.set_num_threads(n)
+    try:
+        torch.set_num_interop_threads(min(2, n))
+    except RuntimeError:
+        # inter-op threads can only be set once, before any parallel work has started
+        pass
+
+
+QUANT_SCOPES = {
+    'all': None,
+    'decoder': ('decoder', 'model.decoder'),
+    'decoder+lm_head': ('decoder', 'model.decoder', 'lm_head'),
+}
+
+
+WEIGHT_DTYPES = {
+    'qint8': torch.qint8,
+    'float16': torch.float16,
+}
+
+
+def _dynamic_qconfig_spec(model, quant_scope, weight_dtype=torch.qint8, min_out_features=64):
+    """
+    Select the nn.Linear layers to quantize. The decoder runs once per generated token while the encoder runs once
+    per input, so restricting int8 to the decoder avoids paying activation quant/dequant on the encoder.
+    Tiny layers are skipped because int8 overhead outweighs their matmul.
+    """
+    if quant_scope not in QUANT_SCOPES:
+        raise ValueError(f"quant_scope can only be set to one of {list(QUANT_SCOPES)}, but is {quant_scope}")
+    prefixes = QUANT_SCOPES[quant_scope]
+    qconfig = float16_dynamic_qconfig if weight_dtype == torch.float16 else default_dynamic_qconfig
+    return {
+        name: qconfig
+        for name, module in model.named_modules()
+        if isinstance(module, nn.Linear)
+        and module.out_features >= min_out_features
+        and (prefixes is None or name.startswith(prefixes))
+    }
+
+
 def dynamic_quantization(
     *,
     check_point='gogamza/kobart-summarization',
@@ -17,24 +131,55 @@ def dynamic_quantization(
     tokenizer=None,
     model = None,
     test=True,
+    batch_size=1,
+    quant_scope='decoder+lm_head',
+    quant_engine='auto',
+    weight_dtype=torch.qint8,
+    warmup_iters=10,
+    measured_iters=100,
+    return_metrics=False,
 ):
-    if model:
-        model_quantized = quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
-    elif check_point:
-        model = AutoModelForSeq2SeqLM.from_pretrained(check_point)
-        model_quantized = quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    """
+    With `return_metrics=True` the `performance_test` metrics are returned alongside the model.
+    `weight_dtype=torch.qint8` dispatches to `linear_dynamic`, which pays off for batched inputs (M >= 16).
+    `weight_dtype=torch.float16` dispatches to `linear_dynamic_fp16`: fp16 weights, fp32 matmul and no activation
+    quantization, which is usually faster for the M=1 steps of autoregressive generate().
+    """
+    _set_quantized_threads()
+    _set_quantized_engine(quant_engine)
 
+    if not model and check_point:
+        model = _load_fp32(check_point)
+    print(f"** dynamic quantization uses {'linear_dynamic_fp16' if weight_dtype == torch.float16 else 'linear_dynamic'}")
+    model_quantized = quantize_dynamic(
+        model, _dynamic_qconfig_spec(model, quant_scope, weight_dtype), dtype=weight_dtype
+    )
+    # quantize_dynamic returns a new module, drop the fp32 one before benchmarking
+    # (a model passed in by the caller stays alive through the caller's reference)
+    del model
+    gc.collect()
+
+    assert any(isinstance(m, nn.quantized.dynamic.Linear) for m in model_quantized.modules()), \
+        "dynamic quantization did not replace any nn.Linear"
+
+    metrics = None
     if test:
-        performance_test.performance_test(
-            check_point=check_point,
-            test_dataset=test_dataset,
-            test_dataset_size=test_dataset_size,
-            cpu_flag=True,
-            test_categories=test_categories,
-            tokenizer=tokenizer,
-            model=model_quantized, 
-        )
+        with torch.inference_mode():
+            metrics = performance_test.performance_test(
+                check_point=check_point,
+                test_dataset=test_dataset,
+                test_dataset_size=test_dataset_size,
+                cpu_flag=True,
+                test_categories=test_categories,
+                tokenizer=tokenizer,
+                model=model_quantized, 
+                batch_size=batch_size,
+                warmup_iters=warmup_iters,
+                measured_iters=measured_iters,
+            )
     
+    if return_metrics:
+        return model_quantized, metrics
     return model_quantized
 
 
@@ -46,40 +191,296 @@ def half_quantization(
     test_categories='rouge,time,size',
     tokenizer=None,
     model = None,
-    test=True
+    test=True,
+    batch_size=1,
+    precision='auto',
+    warmup_iters=10,
+    measured_iters=100,
+    return_metrics=False,
 ):
-    
+    dtype = _half_dtype(precision)
+    cpu_flag = not torch.cuda.is_available()
+    device_type = 'cpu' if cpu_flag else 'cuda'
+
     if model:
-        model.half()
+        model.to(dtype=dtype)
         for layer in model.modules():
             if isinstance(layer, nn.BatchNorm2d):
                 layer.float()
     elif check_point:
-        model = AutoModelForSeq2SeqLM.from_pretrained(check_point)
-        model = model.half()
+        # .to(dtype) is in-place, so only the half precision copy is alive during the benchmark
+        model = _load_fp32(check_point)
+        model = model.to(dtype=dtype)
         
         for layer in model.modules():
             if isinstance(layer, nn.BatchNorm2d):
                 layer.float()
     
+    metrics = None
+    if test:
+        with torch.autocast(device_type=device_type, dtype=dtype, enabled=dtype != torch.float32):
+            metrics = performance_test.performance_test(
+                check_point=check_point,
+                test_dataset=test_dataset,
+                test_dataset_size=test_dataset_size,
+                cpu_flag=cpu_flag,
+                test_categories=test_categories,
+                tokenizer=tokenizer,
+                model=model,
+                batch_size=batch_size,
+                warmup_iters=warmup_iters,
+                measured_iters=measured_iters,
+            )
+        if not cpu_flag:
+            torch.cuda.empty_cache()
+    
+    if return_metrics:
+        return model, metrics
+    return model
+
+
+class _EncoderForExport(nn.Module):
+    def __init__(self, encoder):
+        super().__init__()
+        self.encoder = encoder
+
+    def forward(self, input_ids, attention_mask):
+        return self.encoder(input_ids=input_ids, attention_mask=attention_mask, return_dict=False)[0]
+
+
+class _DecoderForExport(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, decoder_input_ids, encoder_hidden_states, encoder_attention_mask):
+        return self.model(
+            encoder_outputs=(encoder_hidden_states,),
+            attention_mask=encoder_attention_mask,
+            decoder_input_ids=decoder_input_ids,
+            use_cache=False,
+            return_dict=False,
+        )[0]
+
+
+class _OnnxEncoder(nn.Module):
+    def __init__(self, session):
+        super().__init__()
+        self.session = session
+
+    def forward(self, input_ids=None, attention_mask=None, **kwargs):
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        last_hidden_state = self.session.run(None, {
+            'input_ids': input_ids.cpu().numpy(),
+            'attention_mask': attention_mask.cpu().numpy(),
+        })[0]
+        return BaseModelOutput(last_hidden_state=torch.from_numpy(last_hidden_state))
+
+
+def _onnx_forward(session):
+    """
+    `generate()` compatible forward running the decoder + lm_head session. No past key values are returned,
+    so generate() feeds the whole decoder prefix on every step.
+    """
+    def forward(decoder_input_ids=None, attention_mask=None, encoder_outputs=None, **kwargs):
+        encoder_hidden_states = encoder_outputs[0]
+        if attention_mask is None:
+            attention_mask = torch.ones(encoder_hidden_states.shape[:2], dtype=torch.long)
+        logits = session.run(None, {
+            'decoder_input_ids': decoder_input_ids.cpu().numpy(),
+            'encoder_hidden_states': encoder_hidden_states.cpu().numpy(),
+            'encoder_attention_mask': attention_mask.cpu().numpy(),
+        })[0]
+        return Seq2SeqLMOutput(logits=torch.from_numpy(logits), encoder_last_hidden_state=encoder_hidden_states)
+    return forward
+
+
+def onnx_dynamic_quantization(
+    *,
+    check_point='gogamza/kobart-summarization',
+    test_dataset = 'metamong1/summarization_paper',
+    test_dataset_size = 1000,
+    test_categories='rouge,time,size',
+    tokenizer=None,
+    model = None,
+    test=True,
+    batch_size=1,
+    onnx_dir='onnx',
+):
+    """
+    Export the encoder and the decoder + lm_head to ONNX, quantize both with onnxruntime's int8 dynamic
+    quantization and plug the sessions back into the model so the summarization pipeline is unchanged.
+    """
+    import onnxruntime
+    from onnxruntime.quantization import quantize_dynamic as ort_quantize_dynamic, QuantType
+
+    if not model:
+        model = _load_fp32(check_point)
+    if not tokenizer:
+        tokenizer = _load_tokenizer(check_point)
+    model.eval()
+    model.config.use_cache = False
+    os.makedirs(onnx_dir, exist_ok=True)
+
+    dummy = tokenizer('더미 입력 문장입니다.', return_tensors='pt')
+    input_ids, attention_mask = dummy['input_ids'], dummy['attention_mask']
+    decoder_input_ids = torch.full((1, 2), model.config.decoder_start_token_id, dtype=torch.long)
+
+    encoder_path = os.path.join(onnx_dir, 'encoder.onnx')
+    decoder_path = os.path.join(onnx_dir, 'decoder.onnx')
+    with torch.no_grad():
+        encoder_hidden_states = model.get_encoder()(input_ids=input_ids, attention_mask=attention_mask)[0]
+        torch.onnx.export(
+            _EncoderForExport(model.get_encoder()),
+            (input_ids, attention_mask),
+            encoder_path,
+            opset_version=13,
+            input_names=['input_ids', 'attention_mask'],
+            output_names=['last_hidden_state'],
+            dynamic_axes={
+                'input_ids': {0: 'batch', 1: 'src_len'},
+                'attention_mask': {0: 'batch', 1: 'src_len'},
+                'last_hidden_state': {0: 'batch', 1: 'src_len'},
+            },
+        )
+        torch.onnx.export(
+            _DecoderForExport(model),
+            (decoder_input_ids, encoder_hidden_states, attention_mask),
+            decoder_path,
+            opset_version=13,
+            input_names=['decoder_input_ids', 'encoder_hidden_states', 'encoder_attention_mask'],
+            output_names=['logits'],
+            dynamic_axes={
+                'decoder_input_ids': {0: 'batch', 1: 'tgt_len'},
+                'encoder_hidden_states': {0: 'batch', 1: 'src_len'},
+                'encoder_attention_mask': {0: 'batch', 1: 'src_len'},
+                'logits': {0: 'batch', 1: 'tgt_len'},
+            },
+        )
+
+    sessions = {}
+    onnx_size_mb = 0.0
+    for name, path in (('encoder', encoder_path), ('decoder', decoder_path)):
+        quantized_path = path.replace('.onnx', '.int8.onnx')
+        ort_quantize_dynamic(path, quantized_path, weight_type=QuantType.QInt8)
+        sessions[name] = onnxruntime.InferenceSession(quantized_path, providers=['CPUExecutionProvider'])
+        size_mb = os.path.getsize(quantized_path) / (1024 * 1024)
+        onnx_size_mb += size_mb
+        print(f"** {name} int8 onnx size (MB) = {size_mb}")
+
+    parent = getattr(model, 'model', model)
+    parent.encoder = _OnnxEncoder(sessions['encoder'])
+    model.forward = _onnx_forward(sessions['decoder'])
+    # the sessions now run the whole network, drop the eager fp32 decoder and lm_head;
+    # the shared embedding is kept so `model.device` / `model.dtype` still resolve for generate()
+    parent.decoder = None
+    model.lm_head = None
+    gc.collect()
+
     if test:
+        # state_dict() only holds the unused shared embedding, so report the int8 onnx files instead
+        print(f"** int8 onnx size (MB) = {onnx_size_mb}, the 'Model size' below only counts the shared embedding")
         performance_test.performance_test(
             check_point=check_point,
             test_dataset=test_dataset,
             test_dataset_size=test_dataset_size,
-            cpu_flag=False,
+            cpu_flag=True,
             test_categories=test_categories,
             tokenizer=tokenizer,
             model=model,
+            batch_size=batch_size,
         )
-    
+
     return model
 
 
+def benchmark_all(
+    *,
+    check_point='gogamza/kobart-summarization',
+    test_dataset = 'metamong1/summarization_paper',
+    test_dataset_size = 1000,
+    test_categories='rouge,time,size',
+    tokenizer=None,
+    batch_size=1,
+    warmup_iters=5,
+    measured_iters=100,
+):
+    """
+    Benchmark fp32, half precision, int8 dynamic and fp16-weight dynamic variants of one checkpoint in a single
+    process: the fp32 model and the dataset slice are loaded once and every variant is derived from them.
+    Each variant is compared against an fp32 run on the same device.
+    """
+    base = _load_fp32(check_point)
+    if not tokenizer:
+        tokenizer = _load_tokenizer(check_point)
+    dataset = performance_test.load_test_dataset(test_dataset, test_dataset_size)
+    test_kwargs = dict(
+        check_point=check_point,
+        test_dataset=dataset,
+        test_categories=test_categories,
+        tokenizer=tokenizer,
+        batch_size=batch_size,
+        warmup_iters=warmup_iters,
+        measured_iters=measured_iters,
+    )
+
+    def fp32(device):
+        with torch.inference_mode():
+            return performance_test.performance_test(
+                model=copy.deepcopy(base), cpu_flag=device == 'cpu', **test_kwargs
+            )
+
+    def dynamic(weight_dtype):
+        # quantize_dynamic copies, so the cached fp32 model is left untouched
+        return dynamic_quantization(model=base, weight_dtype=weight_dtype, return_metrics=True, **test_kwargs)[1]
+
+    def half():
+        # half_quantization casts the model it is given in place
+        return half_quantization(model=copy.deepcopy(base), return_metrics=True, **test_kwargs)[1]
+
+    devices = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+    # name -> (device, run variant)
+    variants = {f'fp32_{device}': (device, functools.partial(fp32, device)) for device in devices}
+    variants['int8_dynamic'] = ('cpu', functools.partial(dynamic, torch.qint8))
+    variants['fp16_weight_dynamic'] = ('cpu', functools.partial(dynamic, torch.float16))
+    half_dtype = _half_dtype('auto')
+    if half_dtype != torch.float32:
+        variants[str(half_dtype).replace('torch.', '')] = (devices[-1], half)
+
+    results = {}
+    for name, (device, run) in variants.items():
+        print(f"===={name} ({device})====")
+        results[name] = dict(run(), device=device)
+        gc.collect()
+        if device == 'cuda':
+            torch.cuda.empty_cache()
+
+    print(f"{'variant':<22}{'device':>8}{'ms/sample':>12}{'rougeL delta':>14}{'size(MB)':>12}")
+    for name, metrics in results.items():
+        baseline = results[f"fp32_{metrics['device']}"]
+        time_ms = metrics.get('time_avg_ms', float('nan'))
+        rouge_delta = metrics.get('rougeL', float('nan')) - baseline.get('rougeL', float('nan'))
+        size_mb = metrics.get('size_mb', float('nan'))
+        print(f"{name:<22}{metrics['device']:>8}{time_ms:>12.2f}{rouge_delta:>14.4f}{size_mb:>12.2f}")
+
+    return results
+
+
 def main(args):
-    tokenizer = AutoTokenizer.from_pretrained(args.check_point)
+    tokenizer = _load_tokenizer(args.check_point)
 
-    if args.quantization_type == 'half_quantization':
+    if args.quantization_type == 'all':
+        benchmark_all(
+            check_point=args.check_point,
+            test_dataset=args.test_dataset,
+            test_dataset_size=args.test_dataset_size,
+            test_categories=args.test_categories,
+            tokenizer=tokenizer,
+            batch_size=args.batch_size,
+        )
+        return
+    elif args.quantization_type == 'half_quantization':
         model = half_quantization(
             check_point=args.check_point,
             test_dataset=args.test_dataset,
@@ -87,6 +488,8 @@ def main(args):
             test_categories=args.test_categories,
             tokenizer=tokenizer,
             test= args.no_test_flag,
+            batch_size=args.batch_size,
+            precision=args.precision,
         )
     elif args.quantization_type == 'dynamic_quantization':
         model = dynamic_quantization(
@@ -96,7 +499,26 @@ def main(args):
             test_categories=args.test_categories,
             tokenizer=tokenizer,
             test= args.no_test_flag,
+            batch_size=args.batch_size,
+            quant_scope=args.quant_scope,
+            quant_engine=args.quant_engine,
+            weight_dtype=WEIGHT_DTYPES[args.weight_dtype],
+        )
+    elif args.quantization_type == 'onnx_dynamic':
+        # the quantized onnx graphs are written to save_dir (or ./onnx) by the export itself
+        onnx_dynamic_quantization(
+            check_point=args.check_point,
+            test_dataset=args.test_dataset,
+            test_dataset_size=args.test_dataset_size,
+            test_categories=args.test_categories,
+            tokenizer=tokenizer,
+            test= args.no_test_flag,
+            batch_size=args.batch_size,
+            onnx_dir=args.save_dir if args.save_dir else 'onnx',
         )
+        return
+    else:
+        raise ValueError(f"unknown quantization_type {args.quantization_type}")
     
     if args.save_dir:
         model.save_pretrained(args.save_dir)
@@ -107,12 +529,17 @@ def main(args):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
 
-    parser.add_argument('--quantization_type', type=str, default='half_quantization', help='quantization type. ex: half_quantization, dynamic_quantization (default: half_quantization)')
+    parser.add_argument('--quantization_type', type=str, default='half_quantization', help='quantization type. ex: half_quantization, dynamic_quantization, onnx_dynamic, all (default: half_quantization)')
+    parser.add_argument('--precision', type=str, default='auto', help='half_quantization precision. ex: auto, fp16, bf16. fp16 is rejected on cpu (default: auto)')
+    parser.add_argument('--quant_scope', type=str, default='decoder+lm_head', help='nn.Linear layers to quantize in dynamic_quantization. ex: all, decoder, decoder+lm_head (default: decoder+lm_head)')
+    parser.add_argument('--quant_engine', type=str, default='auto', help='int8 kernel backend for dynamic_quantization. ex: auto, fbgemm, qnnpack, onednn (default: auto)')
+    parser.add_argument('--weight_dtype', type=str, default='qint8', choices=list(WEIGHT_DTYPES), help='dynamic_quantization weight dtype. qint8 for batched inputs, float16 for batch size 1 generation (default: qint8)')
     parser.add_argument('--check_point', type=str, default='gogamza/kobart-summarization', help='model checkpoint (default: gogamza/kobart-summarization)')
     parser.add_argument('--test_dataset', type=str, default='metamong1/summarization_paper', help='test dataset (default: metamong1/summarization_paper)')
     parser.add_argument('--test_dataset_size', type=int, default=1000, help='test dataset size (defualt: 1000)')
     parser.add_argument('--cpu_flag', action='store_true', help='use cpu (default: gpu)')
     parser.add_argument('--test_categories', type=str, default='rouge,time,size', help='test categories seperated by , ex: time,size,rouge (defualt: rouge,time,size)')
+    parser.add_argument('--batch_size', type=int, default=1, help='rouge generation batch size, texts are length-bucketed (default: 1)')
     parser.add_argument('--no_test_flag', action='store_false', help='do test performance (default: False)')
     parser.add_argument('--save_dir', type=str, default='', help='save model directory (default: "" ')
 
@@ -28,6 +28,27 @@ def timer(name) :
     yield
     print(f"[{name}] done in {time.time() - t0:.3f} s")
 
+def collate_for_generation(processed_texts, pad_token_id, device) :
+    """
+    Pad tokenized documents (outputs of `preprocess_function_for_prediction`) to the longest one of the batch
+    and build the attention mask, so several documents share one `generate` call.
+    """
+    max_length = max(len(processed['input_ids']) for processed in processed_texts)
+    input_ids = torch.full((len(processed_texts), max_length), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(processed_texts), max_length), dtype=torch.long)
+    doc_type_ids = torch.zeros((len(processed_texts), max_length), dtype=torch.long)
+    for i, processed in enumerate(processed_texts) :
+        length = len(processed['input_ids'])
+        input_ids[i, :length] = torch.tensor(processed['input_ids'])
+        attention_mask[i, :length] = 1
+        if 'doc_type_ids' in processed :
+            doc_type_ids[i, :length] = torch.tensor(processed['doc_type_ids'][0])
+
+    batch = {'input_ids': input_ids, 'attention_mask': attention_mask}
+    if 'doc_type_ids' in processed_texts[0] :
+        batch['doc_type_ids'] = doc_type_ids
+    return {k: v.to(device) for k,v in batch.items()}
+
 def main() :
     parser = HfArgumentParser(
         (ModelArguments, DataTrainingArguments, GenerationArguments)
@@ -53,6 +74,13 @@ def main() :
             config=config,
         )
         model.config.output_attentions = True
+
+    # generate on GPU in fp16 when possible: halves the bytes of the weights and of the kv cache that is
+    # grown every decoding step
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if device.type == "cuda" and model_args.inference_fp16:
+        model = model.half()
+    model = model.to(device).eval()
     
     # ### test 용 code ###
     # load_dotenv(dotenv_path=data_args.use_auth_token_path)
@@ -67,26 +95,56 @@ def main() :
     # text = valid_dataset[idx]['text']
     # title = valid_dataset[idx]['title']
     #####################
+    if  model_args.use_model == 'bigbart_tapt' :
+        data_args.use_doc_type_ids = True
+
+    num_beams = data_args.num_beams
+    if num_beams is not None :
+        generation_args.num_return_sequences = num_beams
+    autocast_dtype = torch.float16 if device.type == "cuda" else torch.bfloat16
+
+    if data_args.predict_file is not None :
+        # batched prediction: the encoder runs once per batch and beam search is batched across documents
+        with open(data_args.predict_file, encoding='utf-8') as f :
+            texts = [line.strip() for line in f if line.strip()]
+        if data_args.use_preprocessing:
+            data_preprocessor = Preprocessor()
+            texts = [data_preprocessor.for_prediction(text) for text in texts]
+
+        with timer('** Generate titles **') :
+            for start in range(0, len(texts), data_args.predict_batch_size) :
+                batch_texts = texts[start:start + data_args.predict_batch_size]
+                batch = collate_for_generation(
+                    [preprocess_function_for_prediction(text, "논문", tokenizer, data_args) for text in batch_texts],
+                    tokenizer.pad_token_id,
+                    device,
+                )
+                with torch.inference_mode(), torch.autocast(device_type=device.type, dtype=autocast_dtype):
+                    summary_ids = model.generate(**batch, num_beams=num_beams, **generation_args.__dict__)
+
+                titles = tokenizer.batch_decode(summary_ids.tolist(), skip_special_tokens=True)
+                num_return_sequences = generation_args.num_return_sequences
+                for i, text in enumerate(batch_texts) :
+                    print('** text: ', text)
+                    for idx, title in enumerate(titles[i * num_return_sequences:(i + 1) * num_return_sequences]) :
+                        print('Gen title', idx, title)
+        return
+
     text = input("요약할 문장을 넣어주세요:")
 
     if data_args.use_preprocessing:
         data_preprocessor = Preprocessor()
         text = data_preprocessor.for_prediction(text)
-
-    if  model_args.use_model == 'bigbart_tapt' :
-        data_args.use_doc_type_ids = True
     
     processed_text = preprocess_function_for_prediction(text, "논문", tokenizer, data_args)
     input_ids = {k: torch.tensor(v) for k,v in processed_text.items()}
     input_ids['input_ids'] = input_ids['input_ids'].unsqueeze(0)
-
-    num_beams = data_args.num_beams
-    if num_beams is not None :
-        generation_args.num_return_sequences = num_beams
+    input_ids = {k: v.to(device) for k,v in input_ids.items()}
 
     with timer('** Generate title **') :
-        summary_ids = model.generate(
-            **input_ids, num_beams=num_beams, **generation_args.__dict__)
+        with torch.inference_mode(), torch.autocast(device_type=device.type, dtype=autocast_dtype):
+            summary_ids = model.generate(
+                **input_ids, num_beams=num_beams, **generation_args.__dict__)
 
         print('** text: ', text)
         # print('** title: ', title)
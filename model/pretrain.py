@@ -155,6 +155,7 @@ def main():
         tokenizer,
         label_pad_token_id=label_pad_token_id,
         pad_to_multiple_of=pad_to_multiple_of,
+        decoder_start_token_id=config["decoder"].decoder_start_token_id if model_args.use_model == "bigbart" else None,
     )
 
     # # wandb
@@ -169,6 +170,16 @@ def main():
     # )
     # wandb.config.update(training_args)
 
+    # opt-in mixed precision; the bf16 autocast itself is applied by the trainer
+    if training_args.use_bf16_autocast:
+        if training_args.fp16:
+            raise ValueError("--use_bf16_autocast and --fp16 are mutually exclusive")
+        if not (torch.cuda.is_available() and torch.cuda.is_bf16_supported()):
+            raise ValueError("--use_bf16_autocast needs a GPU with bf16 support")
+    if training_args.use_tf32:
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+
     trainer = Seq2SeqTrainerWithConditionalDocType(
         args=training_args,
         train_dataset=train_dataset,
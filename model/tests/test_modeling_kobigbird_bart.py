@@ -0,0 +1,81 @@
+import copy
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from transformers.models.encoder_decoder.configuration_encoder_decoder import EncoderDecoderConfig
+
+from models.modeling_kobigbird_bart import (
+    BartConfigWithDoctype,
+    BigBirdConfigWithDoctype,
+    BigBirdEmbeddingsWithDoctype,
+    EncoderDecoderModel,
+)
+
+
+def tiny_model(**config_kwargs):
+    encoder_config = BigBirdConfigWithDoctype(
+        vocab_size=99,
+        hidden_size=32,
+        num_hidden_layers=1,
+        num_attention_heads=2,
+        intermediate_size=37,
+        max_position_embeddings=64,
+        attention_type="original_full",
+    )
+    decoder_config = BartConfigWithDoctype(
+        vocab_size=99,
+        d_model=32,
+        decoder_layers=1,
+        decoder_attention_heads=2,
+        decoder_ffn_dim=37,
+        max_position_embeddings=64,
+    )
+    config = EncoderDecoderConfig.from_encoder_decoder_configs(encoder_config, decoder_config, **config_kwargs)
+    return EncoderDecoderModel(config=config)
+
+
+def test_untied_lm_head_round_trip(tmp_path):
+    model = tiny_model()
+    with torch.no_grad():
+        model.lm_head.weight.normal_()
+    lm_head_weight = model.lm_head.weight.detach().clone()
+    word_embeddings = model.get_input_embeddings().weight.detach().clone()
+    assert not torch.equal(lm_head_weight, word_embeddings)
+
+    model.save_pretrained(tmp_path)
+    loaded = EncoderDecoderModel.from_pretrained(tmp_path)
+
+    assert loaded.lm_head.weight is not loaded.get_input_embeddings().weight
+    assert torch.equal(loaded.lm_head.weight, lm_head_weight)
+    assert torch.equal(loaded.get_input_embeddings().weight, word_embeddings)
+
+
+def test_tied_lm_head_is_opt_in():
+    model = tiny_model(tie_lm_head_to_embeddings=True)
+    assert model.lm_head.weight is model.get_input_embeddings().weight
+
+
+def test_bf16_embeddings_keep_fp32_master_weights():
+    config = copy.deepcopy(tiny_model().config.encoder)
+    config.embed_dtype = "bfloat16"
+    embeddings = BigBirdEmbeddingsWithDoctype(config)
+
+    output = embeddings(input_ids=torch.tensor([[5, 6, 7, 2]]))
+    output.sum().backward()
+
+    assert output.dtype == torch.float32
+    for name, param in embeddings.named_parameters():
+        assert param.dtype == torch.float32, name
+        assert param.grad is None or param.grad.dtype == torch.float32, name
+
+
+def test_final_logits_bias_is_a_buffer():
+    model = tiny_model()
+    state_dict = model.state_dict()
+
+    assert state_dict["final_logits_bias"].shape == (1, 99)
+    assert "lm_head.bias" not in state_dict
+    assert "final_logits_bias" not in dict(model.named_parameters())
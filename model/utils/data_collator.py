@@ -77,6 +77,7 @@ class DataCollatorForTextInfillingDocType:
     mlm_probability: float = 0.15
     poisson_lambda: float = 3.0
     pad_to_multiple_of: Optional[int] = None
+    decoder_start_token_id: Optional[int] = None
 
     def __post_init__(self):
         if self.tokenizer.mask_token is None:
@@ -116,8 +117,18 @@ class DataCollatorForTextInfillingDocType:
         else :
             batch["input_ids"], batch["labels"] = self.mask_tokens(batch,special_tokens_mask)
 
+        # shift the labels here (once per batch, in the loader workers) rather than in the model forward
+        if self.decoder_start_token_id is not None:
+            batch["decoder_input_ids"] = self.shift_tokens_right(batch["labels"])
+
         return batch
 
+    def shift_tokens_right(self, labels: torch.Tensor) -> torch.Tensor:
+        """Shift labels one token to the right, starting with `decoder_start_token_id` and padding ignored labels."""
+        decoder_input_ids = torch.nn.functional.pad(labels[:, :-1], (1, 0), value=self.decoder_start_token_id)
+        decoder_input_ids.masked_fill_(decoder_input_ids == self.label_pad_token_id, self.tokenizer.pad_token_id)
+        return decoder_input_ids
+
     def mask_tokens(self,
                     batch: Dict,
                     special_tokens_mask: Optional[torch.Tensor] = None,
@@ -1,4 +1,5 @@
 import math
+import contextlib
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -47,6 +48,8 @@ class Seq2SeqTrainerWithConditionalDocType(Seq2SeqTrainer):
 
         gen_inputs = deepcopy(inputs)
         gen_inputs.pop("labels")
+        # the collator's decoder_input_ids are the shifted gold labels, generate() must start from scratch
+        gen_inputs.pop("decoder_input_ids", None)
 
         generated_tokens = self.model.generate(
             **gen_inputs,
@@ -62,7 +65,8 @@ class Seq2SeqTrainerWithConditionalDocType(Seq2SeqTrainer):
                 with autocast():
                     outputs = model(**inputs)
             else:
-                outputs = model(**inputs)
+                with self._bf16_autocast():
+                    outputs = model(**inputs)
             if has_labels:
                 if self.label_smoother is not None:
                     loss = self.label_smoother(outputs, inputs["labels"]).mean().detach()
@@ -148,7 +152,20 @@ class Seq2SeqTrainerWithConditionalDocType(Seq2SeqTrainer):
 
         return loss.detach()
 
+    def _bf16_autocast(self):
+        """
+        bf16 autocast requested with `use_bf16_autocast`; the parameters (optimizer master weights) stay fp32.
+        """
+        if self.args.use_bf16_autocast:
+            return torch.autocast(device_type="cuda", dtype=torch.bfloat16)
+        return contextlib.nullcontext()
+
     def compute_loss(self, model: nn.Module, inputs: Dict[str, Union[torch.Tensor, Any]], return_outputs=False):
+        # backward runs outside of the autocast region, as recommended for torch.autocast
+        with self._bf16_autocast():
+            return self._compute_loss(model, inputs, return_outputs=return_outputs)
+
+    def _compute_loss(self, model: nn.Module, inputs: Dict[str, Union[torch.Tensor, Any]], return_outputs=False):
         """
         How the loss is computed by Trainer. By default, all models return the loss in the first element.
         Subclass and override for custom behavior.